@@ -9,12 +9,17 @@ Apache 2.0 License http://www.apache.org/licenses/LICENSE-2.0.txt
 """
 
 from __future__ import print_function
+import math
+import numbers
 import os
+import re
 import shutil
 import git
 import numpy as np
 import glob
 import subprocess
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
 try:
     import yaml
     import f90nml  # from https://f90nml.readthedocs.io/en/latest/
@@ -23,6 +28,10 @@ except ImportError:  # BUG: don't get this exception if payu module loaded, even
     print('On NCI, do the following and try again:')
     print('   module use /g/data/hh5/public/modules; module load conda/analysis3\n')
     raise
+try:  # use LibYAML bindings if available, as they are much faster
+    from yaml import CSafeLoader as SafeLoader, CSafeDumper as SafeDumper
+except ImportError:
+    from yaml import SafeLoader, SafeDumper
 
 # ======================================================
 # from https://gist.github.com/paulkernstock/6df1c7ad37fd71b1da3cb05e70b9f522
@@ -35,196 +44,306 @@ class LiteralString(str):
 
 def change_style(style, representer):
     def new_representer(dumper, data):
-        scalar = representer(dumper, data)
+        scalar = representer(dumper, str(data))  # LibYAML emitter needs a plain str
         scalar.style = style
         return scalar
     return new_representer
 
 represent_literal_str = change_style('|', SafeRepresenter.represent_str)
-yaml.add_representer(LiteralString, represent_literal_str)
+SafeDumper.add_representer(LiteralString, represent_literal_str)
 # ======================================================
 
+# lines to rewrite in sync_data.sh and config.yaml
+_SYNC_RE = re.compile(r'^SYNCDIR=(.*)$', re.M)
+_JOB_RE = re.compile(r'^jobname:.*$', re.M)
+
+# (fname, group, name) of special parameter giving ice turning angle in degrees, used to set cosw, sinw
+_TURNING_ANGLE = ('ice/cice_in.nml', 'dynamics_nml', 'turning_angle')
+
+
+def _matches(a, b):
+    """
+    Return True if template namelist value a matches computed cosw or sinw value b,
+    allowing for float roundoff (e.g. cos(90 degrees) is 6e-17, not 0).
+    """
+    if isinstance(a, numbers.Real) and not isinstance(a, bool):
+        return math.isclose(a, b, rel_tol=1e-12, abs_tol=1e-15)
+    return False
+
+
+def _has_prefix(d, prefixes):
+    """
+    Return True if directory d contains an entry whose name starts with any of prefixes.
+    """
+    try:
+        with os.scandir(d) as it:
+            return any(e.name.startswith(prefixes) for e in it)
+    except FileNotFoundError:
+        return False
+
+
+def _count_outputs(archivepath):
+    """
+    Return number of output[0-9][0-9][0-9]* entries in archivepath.
+    """
+    try:
+        with os.scandir(archivepath) as it:
+            return sum(1 for e in it if e.name.startswith('output') and e.name[6:9].isdigit()
+                       and len(e.name) >= 9)
+    except FileNotFoundError:
+        return 0
+
+
+def _remove_member(exppath, templatepath, expname):
+    """
+    Delete an ensemble member's worktree and branch from template.
+    """
+    subprocess.run(['git', 'worktree', 'remove', '--force', exppath],
+                   cwd=templatepath, check=False)
+    subprocess.run(['git', 'branch', '--quiet', '-D', expname], cwd=templatepath, check=False)
+    if os.path.exists(exppath):
+        shutil.rmtree(exppath)
+
+
+def _build_member(task, cwd, templatepath, template, startfrom, template_values, turningangles,
+                  test=False):
+    """
+    Set up a single ensemble member, varying one parameter from the template.
+
+    Return path to the member's control directory, or None if it was not set up.
+    """
+    fname, group, name, v = task
+    turningangle = (fname, group, name) == _TURNING_ANGLE
+    template_value = template_values[(fname, group, name)]
+
+    sv = str(v)
+    exppath = os.path.join(cwd, '_'.join([template, name, sv]))
+    relexppath = os.path.relpath(exppath, cwd)
+    expname = os.path.basename(exppath)
+    jobname = '_'.join([name, sv])
+
+    try:  # git worktree add accepts an existing empty directory
+        os.makedirs(exppath)
+    except FileExistsError:
+        print('\n -- not creating', relexppath, '- already exists', flush=True)
+        return exppath
+
+    # first check whether this set of parameters differs from template
+    if turningangle:
+        cosw, sinw = turningangles[v]
+        skip = all(_matches(t, w) for t, w in zip(template_value, (cosw, sinw)))
+    else:  # exact, as both values come from decimal text
+        skip = template_value == v
+    if skip:
+        os.rmdir(exppath)
+        print('\n -- not creating', relexppath, '- parameters are identical to', template, flush=True)
+        return None
+
+    # branch is kept in template, so it may outlive a deleted member directory
+    if subprocess.run(['git', 'rev-parse', '--verify', '--quiet', 'refs/heads/'+expname],
+                      cwd=templatepath, stdout=subprocess.DEVNULL).returncode == 0:
+        os.rmdir(exppath)
+        print('\n -- not creating', relexppath, '- branch', expname, 'already exists in', template,
+              '(to recreate this member, first do: git -C', templatepath, 'branch -D', expname + ')', flush=True)
+        return None
+
+    print('\ncreating', relexppath, flush=True)
+
+    # add a worktree of template on a new branch (shares template's git objects)
+# TODO: first checkout commit corresponding to restart?
+    try:
+        subprocess.run(['git', 'worktree', 'add', '--quiet', '-b', expname, exppath, 'HEAD'],
+                       cwd=templatepath, check=True)
+    except subprocess.CalledProcessError:
+        # so a rerun doesn't mistake it for an existing member
+        shutil.rmtree(exppath, ignore_errors=True)
+        raise
+
+    # perturb parameters
+    # NB: use f90nml.patch (a single parse) rather than writing a copy of the cached
+    # template namelist, as patch preserves formatting and comments; otherwise every
+    # member would differ from template and the is_dirty check below would be useless
+    fpath = os.path.join(exppath, fname)
+    if turningangle:
+        f90nml.patch(fpath, {group: {'cosw': cosw, 'sinw': sinw}}, fpath+'_tmp')
+    else:  # general case
+        f90nml.patch(fpath, {group: {name: v}}, fpath+'_tmp')
+    os.replace(fpath+'_tmp', fpath)
+    exprepo = git.Repo(exppath)
+    if not exprepo.is_dirty():  # additional check in case of match after roundoff
+        print(' *** deleting', relexppath, '- parameters are identical to', template, flush=True)
+        _remove_member(exppath, templatepath, expname)
+        return None
+
+    # set SYNCDIR in sync_data.sh
+    sdpath = os.path.join(exppath, 'sync_data.sh')
+    with open(sdpath, 'r') as f:
+        text = f.read()
+    syncbase = os.path.dirname(_SYNC_RE.search(text).group(1))
+    syncdir = os.path.join(syncbase, expname)
+    text = _SYNC_RE.sub(lambda m: 'SYNCDIR='+syncdir, text, count=1)
+    with open(sdpath+'_tmp', 'w') as f:
+        f.write(text)
+    os.replace(sdpath+'_tmp', sdpath)
+    if os.path.exists(syncdir):
+        print(' *** deleting', relexppath, '- SYNCDIR', syncdir, 'already exists', flush=True)
+        _remove_member(exppath, templatepath, expname)
+        return None
+
+    if startfrom != 'rest':
+
+        # create archive symlink
+        if not test:
+            if subprocess.run(['payu', 'sweep'], cwd=exppath, check=False).returncode == 0:
+                subprocess.run(['payu', 'setup'], cwd=exppath, check=False)
+            workpath = os.path.realpath(os.path.join(exppath, 'work'))
+            subprocess.run(['payu', 'sweep'], cwd=exppath, check=True)
+        else:  # simulate effect of payu setup (for testing without payu)
+            workpath = os.path.realpath(os.path.join('test', 'work', expname))
+            archivepath = workpath.replace('/work/', '/archive/')
+            os.makedirs(archivepath, exist_ok=True)
+            # also make template restart symlink if it doesn't exist
+            if template == 'test/1deg_jra55_iaf':  # e.g. testing fresh clone
+                templatearchive = os.path.join(templatepath, 'archive')
+                try:  # another ensemble member may have created it already
+                    os.symlink(archivepath.replace(expname, os.path.basename(template)), templatearchive)
+                except FileExistsError:
+                    pass
+        # payu setup creates archive dir but not symlink,
+        # so infer archive path from work dest and link to it
+        archivepath = workpath.replace('/work/', '/archive/')
+        if _has_prefix(archivepath, ('output', 'restart')):
+            print(' *** deleting', relexppath, '- archive', archivepath, 'already contains restarts and/or outputs', flush=True)
+            _remove_member(exppath, templatepath, expname)
+            return None
+        os.symlink(archivepath, os.path.join(exppath, 'archive'))
+
+        # symlink restart initial conditions
+        d = os.path.join('archive', 'restart'+startfrom)
+        restartpath = os.path.realpath(os.path.join(template, d))
+        os.symlink(restartpath, os.path.join(exppath, d))
+
+        # copy template/output[startfrom]/ice/cice_in.nml
+        d = os.path.join('archive', 'output'+startfrom, 'ice')
+        os.makedirs(os.path.join(exppath, d))
+        shutil.copy(os.path.join(template, d, 'cice_in.nml'),
+                    os.path.join(exppath, d))
+
+    # set jobname in config.yaml to reflect experiment
+    # don't use yaml package as it doesn't preserve comments
+    configpath = os.path.join(exppath, 'config.yaml')
+    with open(configpath, 'r') as f:
+        text = f.read()
+    text = _JOB_RE.sub(lambda m: 'jobname: '+jobname, text, count=1)
+    with open(configpath+'_tmp', 'w') as f:
+        f.write(text)
+    os.replace(configpath+'_tmp', configpath)
+
+    # update metadata.yaml
+    metadata = yaml.load(open(os.path.join(exppath, 'metadata.yaml'), 'r'), Loader=SafeLoader)
+    desc = metadata['description']
+    desc += '\nNOTE: this is a perturbation experiment, but the description above is for the control run.'
+    desc += '\nThis perturbation experiment is based on the control run ' + templatepath
+    if startfrom == 'rest':
+        desc += '\nbut with condition of rest'
+    else:
+        desc += '\nbut with initial condition ' + restartpath
+    if turningangle:
+        desc += '\nand ' + ' -> '.join([fname, group, 'cosw and sinw']) +\
+            ' changed to give a turning angle of ' + sv + ' degrees.'
+    else:
+        desc += '\nand ' + ' -> '.join([fname, group, name]) +\
+            ' changed to ' + sv
+    metadata['description'] = LiteralString(desc)
+    notes = metadata.get('notes')
+    if isinstance(notes, str) and '\n' in notes:  # only multi-line notes need block style
+        metadata['notes'] = LiteralString(notes)
+    metadata['keywords'] += ['perturbation', name]
+    if turningangle:
+        metadata['keywords'] += ['cosw', 'sinw']
+    with open(os.path.join(exppath, 'metadata.yaml'), 'w') as f:
+        yaml.dump(metadata, f, Dumper=SafeDumper, default_flow_style=False, sort_keys=False,
+                  width=10**9)
+
+    # remove run_summary_*.csv
+    files = [os.path.basename(f) for f in glob.glob(os.path.join(exppath, 'run_summary_*.csv'))]
+    if files:
+        subprocess.run(['git', 'rm', '--quiet', '--'] + files, cwd=exppath, check=True)
+
+    # commit
+    exprepo.git.commit(a=True, m='set up '+expname)
+
+    return exppath
+
 
 def ensemble(yamlfile='ensemble.yaml', test=False):
     """
     Create and run an ensemble by varying only one parameter at a time.
     """
-    # alternatively, could loop over all values of all parameters using `itertools.product`
-    # see https://stackoverflow.com/questions/1280667/in-python-is-there-an-easier-way-to-write-6-nested-for-loops
-    indata = yaml.load(open(yamlfile, 'r'), Loader=yaml.SafeLoader)
+    indata = yaml.load(open(yamlfile, 'r'), Loader=SafeLoader)
     template = indata['template']
-    templatepath = os.path.join(os.getcwd(), template)
-    templaterepo = git.Repo(templatepath)
+    cwd = os.getcwd()
+    templatepath = os.path.join(cwd, template)
     startfrom = str(indata['startfrom']).strip().lower().zfill(3)
+    nml_cache = {}  # parsed template namelists, keyed by fname
+    tasks = [(fname, group, name, v)
+             for fname, nmls in indata['namelists'].items()
+             for group, names in nmls.items()
+             for name, values in names.items()
+             for v in values]
+    # template must be the top level of its own git repository, otherwise git would
+    # use an enclosing repository (e.g. if template is an uninitialised submodule)
+    toplevel = subprocess.run(['git', 'rev-parse', '--show-toplevel'], cwd=templatepath,
+                              stdout=subprocess.PIPE, universal_newlines=True).stdout.strip()
+    if not toplevel or os.path.realpath(toplevel) != os.path.realpath(templatepath):
+        raise git.InvalidGitRepositoryError(templatepath)
+
+    # discard stale worktree records, e.g. of deleted ensemble members
+    subprocess.run(['git', 'worktree', 'prune'], cwd=templatepath, check=True)
+
+    # parse template namelists only once per file (f90nml parsing is slow)
+    template_values = {}  # template value(s) for each perturbed parameter
+    for fname, group, name, v in tasks:
+        if fname not in nml_cache:
+            nml_cache[fname] = f90nml.read(os.path.join(templatepath, fname))
+        nml = nml_cache[fname]
+        if (fname, group, name) == _TURNING_ANGLE:
+            template_values[(fname, group, name)] = (nml[group].get('cosw'), nml[group].get('sinw'))
+        else:
+            template_values[(fname, group, name)] = nml[group].get(name)
+
+    # cosw, sinw for each turning angle, computed for all angles at once
+    angles = [v for fname, group, name, v in tasks
+              if (fname, group, name) == _TURNING_ANGLE]
+    rads = np.asarray(angles, dtype=np.float64) * np.pi / 180.
+    turningangles = dict(zip(angles, zip(np.cos(rads).tolist(), np.sin(rads).tolist())))
+
+    # set up ensemble members concurrently (dominated by git, f90nml and payu setup)
     ensemble = []  # paths to ensemble members
-    for fname, nmls in indata['namelists'].items():
-        for group, names in nmls.items():
-            for name, values in names.items():
-                turningangle = [fname, group, name] == ['ice/cice_in.nml', 'dynamics_nml', 'turning_angle']
-                for v in values:
-                    exppath = os.path.join(os.getcwd(), '_'.join([template, name, str(v)]))
-                    relexppath = os.path.relpath(exppath, os.getcwd())
-                    expname = os.path.basename(relexppath)
-
-                    if os.path.exists(exppath):
-                        print('\n -- not creating', relexppath, '- already exists')
-                        ensemble.append(exppath)
-                        continue
-
-                    # first check whether this set of parameters differs from template
-                    with open(os.path.join(templatepath, fname)) as template_nml_file:
-                        nml = f90nml.read(template_nml_file)
-                        if turningangle:
-                            cosw = np.cos(v * np.pi / 180.)
-                            sinw = np.sin(v * np.pi / 180.)
-                            skip = nml[group]['cosw'] == cosw \
-                               and nml[group]['sinw'] == sinw
-                        else:
-                            skip = nml[group][name] == v
-                    if skip:
-                        print('\n -- not creating', relexppath, '- parameters are identical to', template)
-                        continue
-
-                    print('\ncreating', relexppath)
-
-                    # clone template, fix up git remotes, set up new branch
-                    exprepo = templaterepo.clone(exppath)
-                    exprepo.remotes.origin.rename('template')
-                    exprepo.create_remote('origin', templaterepo.remotes.origin.url)
-# TODO: first checkout commit corresponding to restart?
-                    exprepo.git.checkout('HEAD', b=expname)  # switch to a new branch
-
-                    # perturb parameters
-                    fpath = os.path.join(exppath, fname)
-                    if turningangle:
-                        f90nml.patch(fpath, {group: {'cosw': cosw}}, fpath+'_tmp2')
-                        f90nml.patch(fpath+'_tmp2', {group: {'sinw': sinw}}, fpath+'_tmp')
-                        os.remove(fpath+'_tmp2')
-                    else:  # general case
-                        f90nml.patch(fpath, {group: {name: v}}, fpath+'_tmp')
-                    os.rename(fpath+'_tmp', fpath)
-                    if not exprepo.is_dirty():  # additional check in case of match after roundoff
-                        print(' *** deleting', relexppath, '- parameters are identical to', template)
-                        shutil.rmtree(exppath)
-                        continue
-
-                    # set SYNCDIR in sync_data.sh
-                    sdpath = os.path.join(exppath, 'sync_data.sh')
-                    with open(sdpath+'_tmp', 'w') as wf:
-                        with open(sdpath, 'r') as rf:
-                            for line in rf:
-                                if line.startswith('SYNCDIR='):
-                                    syncbase = os.path.dirname(line[len('SYNCDIR='):])
-                                    syncdir = os.path.join(syncbase, expname)
-                                    wf.write('SYNCDIR='+syncdir+'\n')
-                                else:
-                                    wf.write(line)
-                    os.rename(sdpath+'_tmp', sdpath)
-                    if os.path.exists(syncdir):
-                        print(' *** deleting', relexppath, '- SYNCDIR', syncdir, 'already exists')
-                        shutil.rmtree(exppath)
-                        continue
-
-                    if startfrom != 'rest':
-
-                        # create archive symlink
-                        if not test:
-                            subprocess.run('cd ' + exppath + ' && payu sweep && payu setup', check=False, shell=True)
-                            workpath = os.path.realpath(os.path.join(exppath, 'work'))
-                            subprocess.run('cd ' + exppath + ' && payu sweep', check=True, shell=True)
-                        else:  # simulate effect of payu setup (for testing without payu)
-                            workpath = os.path.realpath(os.path.join('test', 'work', expname))
-                            os.makedirs(workpath)
-                            os.symlink(workpath, os.path.join(exppath, 'work'))
-                            archivepath = workpath.replace('/work/', '/archive/')
-                            os.makedirs(archivepath)
-                            workpath = os.path.realpath(os.path.join(exppath, 'work'))
-                            os.remove(os.path.join(exppath, 'work'))
-                            shutil.rmtree(workpath)
-                            # also make template restart symlink if it doesn't exist
-                            if template == 'test/1deg_jra55_iaf':  # e.g. testing fresh clone
-                                templatearchive = os.path.join(templatepath, 'archive')
-                                if not os.path.exists(templatearchive):
-                                    os.symlink(archivepath.replace(expname, os.path.basename(template)), templatearchive)
-                        # payu setup creates archive dir but not symlink,
-                        # so infer archive path from work dest and link to it
-                        archivepath = workpath.replace('/work/', '/archive/')
-                        if glob.glob(os.path.join(archivepath, 'output*')) +\
-                           glob.glob(os.path.join(archivepath, 'restart*')):
-                            print(' *** deleting', relexppath, '- archive', archivepath, 'already contains restarts and/or outputs')
-                            shutil.rmtree(exppath)
-                            continue
-                        os.symlink(archivepath, os.path.join(exppath, 'archive'))
-
-                        # symlink restart initial conditions
-                        d = os.path.join('archive', 'restart'+startfrom)
-                        restartpath = os.path.realpath(os.path.join(template, d))
-                        os.symlink(restartpath, os.path.join(exppath, d))
-
-                        # copy template/output[startfrom]/ice/cice_in.nml
-                        d = os.path.join('archive', 'output'+startfrom, 'ice')
-                        os.makedirs(os.path.join(exppath, d))
-                        shutil.copy(os.path.join(template, d, 'cice_in.nml'),
-                                    os.path.join(exppath, d))
-
-                    # set jobname in config.yaml to reflect experiment
-                    # don't use yaml package as it doesn't preserve comments
-                    configpath = os.path.join(exppath, 'config.yaml')
-                    with open(configpath+'_tmp', 'w') as wf:
-                        with open(configpath, 'r') as rf:
-                            for line in rf:
-                                if line.startswith('jobname:'):
-                                    wf.write('jobname: '+'_'.join([name, str(v)])+'\n')
-                                else:
-                                    wf.write(line)
-                    os.rename(configpath+'_tmp', configpath)
-
-                    # update metadata.yaml
-                    metadata = yaml.load(open(os.path.join(exppath, 'metadata.yaml'), 'r'), Loader=yaml.SafeLoader)
-                    desc = metadata['description']
-                    desc += '\nNOTE: this is a perturbation experiment, but the description above is for the control run.'
-                    desc += '\nThis perturbation experiment is based on the control run ' + templatepath
-                    if startfrom == 'rest':
-                        desc += '\nbut with condition of rest'
-                    else:
-                        desc += '\nbut with initial condition ' + restartpath
-                    if turningangle:
-                        desc += '\nand ' + ' -> '.join([fname, group, 'cosw and sinw']) +\
-                            ' changed to give a turning angle of ' + str(v) + ' degrees.'
-                    else:
-                        desc += '\nand ' + ' -> '.join([fname, group, name]) +\
-                            ' changed to ' + str(v)
-                    metadata['description'] = LiteralString(desc)
-                    metadata['notes'] = LiteralString(metadata['notes'])
-                    metadata['keywords'] += ['perturbation', name]
-                    if turningangle:
-                        metadata['keywords'] += ['cosw', 'sinw']
-                    with open(os.path.join(exppath, 'metadata.yaml'), 'w') as f:
-                        yaml.dump(metadata, f, default_flow_style=False, sort_keys=False)
-
-                    # remove run_summary_*.csv
-                    for f in glob.glob(os.path.join(exppath, 'run_summary_*.csv')):
-                        exprepo.git.rm(os.path.basename(f))
-
-                    # commit
-                    exprepo.git.commit(a=True, m='set up '+expname)
-
-                    ensemble.append(exppath)
+    if tasks:
+        build = partial(_build_member, cwd=cwd, templatepath=templatepath, template=template,
+                        startfrom=startfrom, template_values=template_values,
+                        turningangles=turningangles, test=test)
+        with ProcessPoolExecutor(max_workers=min(8, len(tasks))) as ex:
+            ensemble = [p for p in ex.map(build, tasks) if p]
 
 # count existing runs and do additional runs if needed
+    # payu run just submits jobs, so start all submissions together and then wait
     if indata['nruns'] > 0:
+        procs = []
         for exppath in ensemble:
-            doneruns = len(glob.glob(os.path.join(exppath, 'archive', 'output[0-9][0-9][0-9]*'))) - 1
+            doneruns = _count_outputs(os.path.join(exppath, 'archive')) - 1
             newruns = indata['nruns'] - doneruns
             if newruns > 0:
-#                cmd = 'cd ' + exppath + ' && payu sweep && payu run -n ' + str(newruns)
-                cmd = 'cd ' + exppath + ' && payu run -n ' + str(newruns)
-                if test:
-                    cmd = '# ' + cmd
-                print('\n'+cmd)
-                subprocess.run(cmd, check=False, shell=True)
+#                cmd = ['payu', 'sweep'] then ['payu', 'run', '-n', str(newruns)]
+                cmd = ['payu', 'run', '-n', str(newruns)]
+                print('\n' + ('# ' if test else '') + 'cd ' + exppath + ' && ' + ' '.join(cmd))
+                if not test:
+                    procs.append(subprocess.Popen(cmd, cwd=exppath))
             else:
                 print('\n --', exppath, 'has already completed', doneruns, 'runs')
+        for proc in procs:
+            proc.wait()
     print()
 
 
@@ -242,4 +361,4 @@ if __name__ == '__main__':
     args = parser.parse_args()
     yamlfile = vars(args)['yamlfile']
     test = vars(args)['test']
-ensemble(yamlfile, test=test)
+    ensemble(yamlfile, test=test)